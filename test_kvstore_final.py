@@ -0,0 +1,415 @@
+import contextlib
+import errno
+import mmap
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import kvstore_final
+from kvstore_final import KeyValueStore, _PackedIndex
+
+
+class StoreTestCase(unittest.TestCase):
+    """Runs each test in a fresh directory: the store works on ./data.db."""
+
+    def setUp(self):
+        cwd = os.getcwd()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(tmp.name)
+
+    def write(self, name, data):
+        with open(name, "wb") as f:
+            f.write(data)
+
+
+class MainTest(StoreTestCase):
+    def run_main(self, data, **patches):
+        """Feed data to main() as stdin and return what it writes."""
+        self.write("stdin", data)
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch.object(
+                sys, "stdin", stack.enter_context(open("stdin", "rb"))))
+            stack.enter_context(mock.patch.object(
+                sys, "stdout", stack.enter_context(open("stdout", "wb"))))
+            for name, value in patches.items():
+                stack.enter_context(mock.patch.object(kvstore_final, name, value))
+            kvstore_final.main()
+        with open("stdout", "rb") as f:
+            return f.read()
+
+    def test_lines_split_across_reads(self):
+        self.assertEqual(self.run_main(b"SET alpha 1\nGET alpha\nGET beta\n", READ_SIZE=3),
+                         b"OK\n1\n\n")
+
+    def test_last_line_without_newline(self):
+        self.assertEqual(self.run_main(b"SET a 1\nGET a"), b"OK\n1\n")
+
+    def test_exit_ignores_later_lines(self):
+        self.assertEqual(self.run_main(b"SET a 1\nEXIT\nSET b 2\nGET a\n"), b"OK\n")
+        self.assertEqual(self.run_main(b"GET a\nGET b\n"), b"1\n\n")
+
+    def test_lower_case_and_errors(self):
+        data = b"set a 1\nget a\nFOO\nSET a\nGET\n\n   \nSET a 1 2\nGET a b\nexit\nGET a\n"
+        err = b"ERR: Invalid command\n"
+        self.assertEqual(self.run_main(data), b"OK\n1\n" + err * 5)
+
+    def test_replies_in_order_across_cut_offs(self):
+        rng = random.Random(1)
+        lines, expected, kv = [], [], {}
+        for i in range(500):
+            key = b"k%d" % rng.randrange(20)
+            if rng.random() < 0.5:
+                kv[key] = b"v%d" % i * rng.randrange(1, 8)
+                lines.append(b"SET %b %b" % (key, kv[key]))
+                expected.append(b"OK\n")
+            else:
+                lines.append(b"GET " + key)
+                expected.append(kv.get(key, b"") + b"\n")
+        data, expected = b"\n".join(lines) + b"\n", b"".join(expected)
+        for patches in ({}, dict(READ_SIZE=7, EXEC_LINES=3, REPLY_BYTES=16),
+                        dict(EXEC_LINES=1, REPLY_BYTES=1, POSIX=False)):
+            with self.subTest(**patches):
+                self.assertEqual(self.run_main(data, **patches), expected)
+                os.remove("data.db")
+
+
+class BatchSyncTest(StoreTestCase):
+    def test_flush_syncs_data_db(self):
+        synced, inodes = threading.Event(), []
+
+        def fdatasync(fd):
+            inodes.append(os.fstat(fd).st_ino)
+            synced.set()
+
+        with mock.patch.object(kvstore_final, "fdatasync", fdatasync), \
+                KeyValueStore(fsync_mode="batch") as store:
+            store.set_bytes(b"a", b"1")  # outside batch(): flushed right away
+            self.assertTrue(synced.wait(5))
+            self.assertEqual(inodes, [os.stat("data.db").st_ino])
+
+    def test_sync_error_is_raised_once(self):
+        errors = [OSError(errno.EIO, "I/O error")]
+
+        def fdatasync(fd):
+            if errors:
+                raise errors.pop()
+
+        with mock.patch.object(kvstore_final, "fdatasync", fdatasync), \
+                KeyValueStore(fsync_mode="batch") as store:
+            store.set_bytes(b"a", b"1")
+            deadline = time.monotonic() + 5
+            with self.assertRaises(OSError) as raised:
+                while time.monotonic() < deadline:  # until the worker has failed
+                    store.flush()
+                    time.sleep(0.01)
+            self.assertEqual(raised.exception.errno, errno.EIO)
+            store.flush()
+            store.set_bytes(b"b", b"2")
+        with KeyValueStore() as store:
+            self.assertEqual(store.get_bytes(b"b"), b"2")
+
+    def test_close_stops_worker(self):
+        store = KeyValueStore(fsync_mode="batch")
+        worker = store._sync_thread
+        self.assertTrue(worker.is_alive())
+        store.set_bytes(b"a", b"1")
+        store.close()
+        self.assertFalse(worker.is_alive())
+
+
+class LogEndTest(StoreTestCase):
+    def test_nul_in_values_survives_restart(self):
+        for preallocate in (False, True):
+            with self.subTest(preallocate=preallocate):
+                with KeyValueStore(preallocate=preallocate) as store:
+                    store.set_bytes(b"a", b"1")
+                    store.set_bytes(b"b", b"x\0y")
+                    store.set_bytes(b"c\0", b"\0")
+                    store.set_bytes(b"d", b"3")
+                size = os.path.getsize("data.db")
+                with KeyValueStore() as store:  # never truncates the log
+                    self.assertEqual(store.get_bytes(b"b"), b"x\0y")
+                    self.assertEqual(store.get_bytes(b"c\0"), b"\0")
+                    self.assertEqual(store.get_bytes(b"d"), b"3")
+                    store.set_bytes(b"e", b"4")
+                self.assertGreaterEqual(os.path.getsize("data.db"), size)
+                with KeyValueStore(preallocate=preallocate) as store:
+                    self.assertEqual(store.get_bytes(b"b"), b"x\0y")
+                    self.assertEqual(store.get_bytes(b"e"), b"4")
+                os.remove("data.db")
+
+    def test_whitespace_is_rejected(self):
+        with KeyValueStore() as store:
+            for key, value in ((b"a", b"x\n\0y"), (b"a", b"x y"), (b"a", b""),
+                               (b"a\nb", b"1"), (b"", b"1"), (b"a", b"\t")):
+                with self.assertRaises(ValueError):
+                    store.set_bytes(key, value)
+            with self.assertRaises(ValueError):
+                store.set("a", "x y")
+            for i in range(5):
+                store.set_bytes(b"k%d" % i, b"v")
+        with KeyValueStore() as store:
+            self.assertIsNone(store.get_bytes(b"a"))
+            self.assertEqual(store.get_bytes(b"k4"), b"v")
+        with open("data.db", "rb") as f:
+            self.assertEqual(f.read(), b"".join(b"SET k%d v\n" % i for i in range(5)))
+
+    def test_preallocated_space_and_torn_record(self):
+        self.write("data.db", b"SET a 1\nSET b x" + b"\0" * 4096)
+        with KeyValueStore() as store:
+            self.assertEqual(store.get_bytes(b"a"), b"1")
+            self.assertIsNone(store.get_bytes(b"b"))
+            store.set_bytes(b"c", b"2")
+        with open("data.db", "rb") as f:
+            self.assertEqual(f.read(16), b"SET a 1\nSET c 2\n")
+        self.assertEqual(os.path.getsize("data.db"), 15 + 4096)
+
+
+class ScanLogTest(unittest.TestCase):
+    LOG = (b"SET a 1\nSETV big 10 20\n\nVLOG 3\nSET  b\t\x002 \r\nnoise\n"
+           b"SET a 2\nSET too many fields\nSETV x 1\nGET a\n  SET c 3\nSET d 4")
+
+    def replayed(self, replay):
+        store = KeyValueStore.__new__(KeyValueStore)
+        store._kv, store._vlog_gen = {}, 0
+        replay(store)
+        return store._kv, store._vlog_gen
+
+    def test_matches_replay(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        # Run the scanner un-jitted: numba.njit keeps the original as py_func.
+        scan = getattr(kvstore_final._scan_log, "py_func", kvstore_final._scan_log)
+        expected = self.replayed(lambda store: store._replay(self.LOG.split(b"\n")))
+        self.assertEqual(expected[0][b"big"], (10, 20))
+        for chunk in (1, 5, 16, 1 << 20):  # windows cutting lines anywhere
+            with self.subTest(chunk=chunk), \
+                    mock.patch.object(kvstore_final, "np", numpy), \
+                    mock.patch.object(kvstore_final, "_scan_log", scan), \
+                    mock.patch.object(kvstore_final, "REPLAY_CHUNK", chunk):
+                with mmap.mmap(-1, len(self.LOG)) as mm:
+                    mm.write(self.LOG)
+                    self.assertEqual(self.replayed(
+                        lambda store: store._replay_scanned(mm, len(mm))), expected)
+
+
+class CompactionTest(StoreTestCase):
+    def test_restart_after_compaction(self):
+        for threshold in (None, 16):
+            with self.subTest(value_threshold=threshold), \
+                    mock.patch.object(kvstore_final, "COMPACT_MIN_BYTES", 4096):
+                expected = {}
+                with KeyValueStore(value_threshold=threshold) as store:
+                    for round_ in range(30):
+                        with store.batch():
+                            for i in range(200):
+                                key, value = b"k%d" % i, b"v%d-%d-" % (round_, i) * 3
+                                store.set_bytes(key, value)
+                                expected[key] = value
+                    compacted_size = os.path.getsize("data.db")
+                self.assertLess(compacted_size, 30 * sum(
+                    len(k) + len(v) for k, v in expected.items()) // 4)
+                self.assertFalse(os.path.exists("data.db.tmp"))
+                if threshold is not None:
+                    self.assertEqual(len([n for n in os.listdir(".")
+                                          if n.startswith("vlog.db.")]), 1)
+                with KeyValueStore(value_threshold=threshold) as store:
+                    for key, value in expected.items():
+                        self.assertEqual(store.get_bytes(key), value)
+                for name in os.listdir("."):
+                    os.remove(name)
+
+
+    def test_rename_is_synced(self):
+        def fsync_dir(path):
+            self.assertFalse(os.path.exists("data.db.tmp"))  # after the rename
+            calls.append(path)
+
+        calls = []
+        with KeyValueStore() as store, \
+                mock.patch.object(kvstore_final, "_fsync_dir", fsync_dir):
+            store.set_bytes(b"a", b"1")
+            store.compact()
+        self.assertEqual(calls, [kvstore_final.DATA_FILE])
+
+    def test_queued_records_survive_compaction(self):
+        with KeyValueStore() as store:
+            store.set_bytes(b"a", b"1")
+            with store.batch():
+                store.set_bytes(b"a", b"2")
+                store.set_bytes(b"b", b"3")
+                store.compact()  # taken from _kv; the queue is dropped
+                store.set_bytes(b"c", b"4")
+        with open("data.db", "rb") as f:
+            self.assertEqual(f.read(), b"SET a 2\nSET b 3\nSET c 4\n")
+        with KeyValueStore() as store:
+            self.assertEqual([store.get_bytes(k) for k in (b"a", b"b", b"c")],
+                             [b"2", b"3", b"4"])
+
+
+class ValueLogTest(StoreTestCase):
+    def test_pointer_past_eof_is_dropped(self):
+        self.write("vlog.db.0", b"hello")
+        self.write("data.db", b"SETV a 0 5\nSETV b 3 10\nSET c 1\n")
+        with KeyValueStore() as store:
+            self.assertEqual(store.get_bytes(b"a"), b"hello")
+            self.assertIsNone(store.get_bytes(b"b"))
+            self.assertEqual(store.get_bytes(b"c"), b"1")
+
+    def test_pointers_without_value_log_are_dropped(self):
+        self.write("data.db", b"SETV a 0 5\nSET c 1\n")
+        with KeyValueStore() as store:
+            self.assertIsNone(store.get_bytes(b"a"))
+            self.assertEqual(store.get_bytes(b"c"), b"1")
+
+    def test_stray_generations_are_removed(self):
+        self.write("data.db", b"VLOG 2\nSETV a 0 5\n")
+        for name in ("vlog.db.1", "vlog.db.3", "vlog.db.tmp"):
+            self.write(name, b"stray")
+        self.write("vlog.db.2", b"hello")
+        with KeyValueStore() as store:
+            self.assertEqual(store.get_bytes(b"a"), b"hello")
+        self.assertEqual(sorted(os.listdir(".")),
+                         ["data.db", "vlog.db.2", "vlog.db.tmp"])
+
+    def test_failed_compaction_keeps_current_generation(self):
+        expected = {}
+        with mock.patch.object(kvstore_final, "COMPACT_MIN_BYTES", 1 << 30), \
+                KeyValueStore(value_threshold=4) as store:
+            for round_ in range(5):
+                for i in range(50):
+                    key, value = b"k%d" % i, b"%d-%d-" % (round_, i) * 4
+                    store.set_bytes(key, value)
+                    expected[key] = value
+            kvstore_final.COMPACT_MIN_BYTES = 1024  # restored by mock.patch
+            with mock.patch("os.replace", side_effect=OSError(errno.ENOSPC, "full")):
+                with self.assertRaises(OSError):
+                    store.compact()
+            self.assertEqual(sorted(os.listdir(".")), ["data.db", "vlog.db.0"])
+            kvstore_final.COMPACT_MIN_BYTES = 1 << 30
+            store.set_bytes(b"new", b"N" * 40)
+            expected[b"new"] = b"N" * 40
+            for key, value in expected.items():
+                self.assertEqual(store.get_bytes(key), value)
+        with mock.patch.object(kvstore_final, "COMPACT_MIN_BYTES", 1024), \
+                KeyValueStore(value_threshold=4) as store:
+            for key, value in expected.items():
+                self.assertEqual(store.get_bytes(key), value)
+            store.compact()  # and a compaction that succeeds afterwards
+        self.assertEqual(sorted(os.listdir(".")), ["data.db", "vlog.db.1"])
+        with KeyValueStore(value_threshold=4) as store:
+            for key, value in expected.items():
+                self.assertEqual(store.get_bytes(key), value)
+
+    def test_queued_values_are_readable(self):
+        with KeyValueStore(value_threshold=4) as store:
+            with store.batch():
+                store.set_bytes(b"a", b"x" * 100)
+                self.assertEqual(store.get_bytes(b"a"), b"x" * 100)
+                store.set_bytes(b"b", b"y" * 100)
+            self.assertEqual(store.get_bytes(b"b"), b"y" * 100)
+        with KeyValueStore(value_threshold=4) as store:
+            self.assertEqual(store.get_bytes(b"a"), b"x" * 100)
+            self.assertEqual(store.get_bytes(b"b"), b"y" * 100)
+
+
+class PortabilityTest(StoreTestCase):
+    def test_without_posix_calls(self):
+        """What Windows lacks: writev, pread, select() on files, and
+        directory fsync."""
+        with mock.patch.dict(os.__dict__), \
+                mock.patch.object(kvstore_final, "POSIX", False), \
+                mock.patch.object(kvstore_final, "COMPACT_MIN_BYTES", 1024):
+            del os.writev, os.pread
+            expected = {}
+            with KeyValueStore(value_threshold=8) as store:
+                for round_ in range(10):
+                    with store.batch():
+                        for i in range(50):
+                            key, value = b"k%d" % i, b"%d-%d" % (round_, i) * (i % 4 + 1)
+                            store.set_bytes(key, value)
+                            expected[key] = value
+                self.assertGreater(store._vlog_gen, 0)  # compacted along the way
+            with KeyValueStore(value_threshold=8) as store:
+                for key, value in expected.items():
+                    self.assertEqual(store.get_bytes(key), value)
+
+
+class PackedIndexTest(StoreTestCase):
+    def assertSameAsDict(self, index, expected):
+        self.assertEqual(len(index), len(expected))
+        self.assertEqual(dict(index.items()), expected)
+        for key, value in expected.items():
+            self.assertEqual(index.get(key), value)
+
+    def test_matches_dict(self):
+        rng = random.Random(0)
+        index, expected = _PackedIndex(8), {}  # tiny, so it regrows often
+        for _ in range(20000):
+            key = b"k%d" % rng.randrange(3000)
+            if rng.random() < 0.2:
+                if key in expected:
+                    del index[key]
+                    del expected[key]
+                else:
+                    with self.assertRaises(KeyError):
+                        del index[key]
+            elif rng.random() < 0.1:
+                index[key] = expected[key] = (rng.randrange(1 << 40), rng.randrange(1 << 20))
+            else:
+                index[key] = expected[key] = b"v" * rng.randrange(50)
+            self.assertEqual(index.get(key), expected.get(key))
+        self.assertSameAsDict(index, expected)
+        self.assertIsNone(index.get(b"missing"))
+
+    def test_garbage_rebuild(self):
+        index = _PackedIndex()
+        index[b"keep"] = b"k"
+        for i in range(40):  # overwrites leave the arena mostly garbage
+            index[b"big"] = bytes([i]) * 100000
+        self.assertLess(len(index._arena), 1 << 20)
+        self.assertSameAsDict(index, {b"keep": b"k", b"big": bytes([39]) * 100000})
+
+    def test_store_restart(self):
+        expected = {b"k%d" % i: b"v%d" % i for i in range(100)}
+        with KeyValueStore(packed_index_keys=10) as store:
+            for key, value in expected.items():
+                store.set_bytes(key, value)
+            store.set_bytes(b"k5", b"again")
+            expected[b"k5"] = b"again"
+            self.assertIsInstance(store._kv, _PackedIndex)
+        with KeyValueStore(packed_index_keys=10) as store:
+            self.assertIsInstance(store._kv, _PackedIndex)
+            self.assertSameAsDict(store._kv, expected)
+
+    def test_store_with_value_log_and_compaction(self):
+        expected = {}
+        with mock.patch.object(kvstore_final, "COMPACT_MIN_BYTES", 1024):
+            with KeyValueStore(packed_index_keys=10, value_threshold=8) as store:
+                for round_ in range(10):
+                    with store.batch():
+                        for i in range(60):  # short values inline, long ones as pointers
+                            key, value = b"k%d" % i, b"%d-%d" % (round_, i) * (i % 5 + 1)
+                            store.set_bytes(key, value)
+                            expected[key] = value
+                self.assertIsInstance(store._kv, _PackedIndex)
+                self.assertGreater(store._vlog_gen, 0)  # pointers were moved
+                for key, value in expected.items():
+                    self.assertEqual(store.get_bytes(key), value)
+            with KeyValueStore(packed_index_keys=10, value_threshold=8) as store:
+                self.assertIsInstance(store._kv, _PackedIndex)
+                for key, value in expected.items():
+                    self.assertEqual(store.get_bytes(key), value)
+
+
+if __name__ == "__main__":
+    unittest.main()